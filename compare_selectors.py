@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+"""
+NAME
+       compare_selectors - Compare the tags chosen by several selectors of demultadapt
+
+SYNOPSIS
+       python compare_selectors.py -e ENGINE -e ENGINE [OPTION] TAG_FILE
+
+DESCRIPTION
+       Each read (pair) of a fastq file is given to every ENGINE. Reads for which the
+       engines do not choose the same tag are printed with their name, and the number of
+       reads selected by second is given for each engine. Only the selection is timed,
+       reads are parsed once for all engines.
+
+ENGINE format
+            name or name:rate with name in:
+
+                std                       - Std_selector
+                levenshtein:RATE          - Levenshtein_selector
+                levenshtein-all:RATE      - LevenshteinAllSelector
+                fullscan-levenshtein:RATE - Levenshtein_selector computing every ratio
+                fullscan-levenshtein-all:RATE
+                                          - LevenshteinAllSelector computing every ratio
+
+            The fullscan engines are the Levenshtein selectors without exact match index,
+            length groups or length bound, they are the reference for the faster engines.
+"""
+from __future__ import print_function
+
+import sys
+import time
+from demultadapt import ( Levenshtein_selector, LevenshteinAllSelector, Std_selector,
+                          Fastq_read, lane_reads, read_tag_file )
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+
+class FullScanLevenshteinSelector( Levenshtein_selector ) :
+    """
+    Selection computing every ratio, as Levenshtein_selector did
+    before the exact match index, the length bound and the length groups.
+    """
+
+    def _single_select( self, sequence ) :
+        from Levenshtein import ratio
+
+        distances = []
+        for (adaptator, output_file) in self.tags_table :
+            dist = ratio( adaptator, sequence[ : len( adaptator ) ] )
+            if dist == 1.0 :
+                return (adaptator, output_file)
+
+            distances.append( dist )
+
+        max_dist = max( distances )
+        if max_dist >= self.rate and distances.count( max_dist ) == 1 :
+            return self.tags_table[ distances.index( max_dist ) ]
+
+        return None
+
+    def _paired_select( self, sequence_1, sequence_2 ) :
+        from Levenshtein import ratio
+        distances_1 = []
+        distances_2 = []
+
+        for line in self.tags_table :
+            adaptator = line[ 0 ]
+            distances_1.append( ratio( adaptator, sequence_1[ : len( adaptator ) ] ) )
+            distances_2.append( ratio( adaptator, sequence_2[ : len( adaptator ) ] ) )
+
+        return self._best_of_pair( distances_1, distances_2 )
+
+
+class FullScanLevenshteinAllSelector( FullScanLevenshteinSelector ) :
+    """
+    LevenshteinAllSelector computing every ratio.
+    """
+
+    def _paired_select( self, sequence_1, sequence_2 ) :
+        from Levenshtein import ratio
+        distances_1 = []
+        distances_2 = []
+
+        for line in self.tags_table :
+            adaptator = line[ 0 ]
+            distances_1.append( ratio( adaptator, sequence_1[ : len( adaptator ) ] ) )
+            distances_2.append( ratio( adaptator, sequence_2[ : len( adaptator ) ] ) )
+
+        max_dist_1 = max( distances_1 )
+        max_dist_2 = max( distances_2 )
+
+        if ( max_dist_1 >= self.rate and max_dist_2 >= self.rate
+           and distances_1.count( max_dist_1 ) == distances_2.count( max_dist_2 ) == 1 ) :
+               adapt_1 = self.tags_table[ distances_1.index( max_dist_1 ) ]
+               adapt_2 = self.tags_table[ distances_2.index( max_dist_2 ) ]
+               if adapt_1 == adapt_2 :
+                    return adapt_1
+        return None
+
+
+# name : ( selector class, rate is needed )
+ENGINES = {
+    "std" : ( Std_selector, False ),
+    "levenshtein" : ( Levenshtein_selector, True ),
+    "levenshtein-all" : ( LevenshteinAllSelector, True ),
+    "fullscan-levenshtein" : ( FullScanLevenshteinSelector, True ),
+    "fullscan-levenshtein-all" : ( FullScanLevenshteinAllSelector, True ),
+}
+
+
+def make_engine( spec, tags, single_end ) :
+    """
+    Return the selector described by spec (see ENGINE format) for tags.
+    The tags_table of the selector is [ ( tag, index ), ... ].
+    """
+    name, sep, rate = spec.partition( ":" )
+    if name not in ENGINES :
+        raise ValueError( "unknown engine '%s', engines are %s" % ( name, ", ".join( sorted( ENGINES ) ) ) )
+
+    selector_class, need_rate = ENGINES[ name ]
+    tags_table = [ ( tag, index ) for index, tag in enumerate( tags ) ]
+    if need_rate :
+        if not rate :
+            raise ValueError( "engine '%s' needs a rate, i.e. %s:0.8" % ( name, name ) )
+        return selector_class( tags_table, single_end, float( rate ) )
+
+    if rate :
+        raise ValueError( "engine '%s' has no rate" % name )
+    return selector_class( tags_table, single_end )
+
+
+def read_chunks( reads, chunk_size=10000 ) :
+    """
+    Yield lists of ( read name, sequences ) from reads (see demultadapt.lane_reads),
+    sequences has one sequence by member.
+    """
+    chunk = []
+    for str_reads in reads :
+        fastq_reads = [ Fastq_read( str_read ) for str_read in str_reads ]
+        chunk.append( ( fastq_reads[0].name, tuple( read.seq for read in fastq_reads ) ) )
+        if len( chunk ) == chunk_size :
+            yield chunk
+            chunk = []
+
+    if chunk :
+        yield chunk
+
+
+class Comparison( object ) :
+    """
+    Result of compare_engines:
+        nb_reads         - number of reads (pairs) compared.
+        nb_disagreements - number of reads for which the engines do not choose the same tag.
+        disagreements    - [ ( read name, [ index chosen by each engine ] ), ... ] the first max_disagreements.
+        seconds          - time spent by each engine to select reads.
+        assigned         - number of reads having a tag for each engine.
+    """
+    def __init__( self, nb_engines, max_disagreements ) :
+        self.max_disagreements = max_disagreements
+        self.nb_reads = 0
+        self.nb_disagreements = 0
+        self.disagreements = []
+        self.seconds = [ 0.0 ] * nb_engines
+        self.assigned = [ 0 ] * nb_engines
+
+    def reads_per_second( self, engine ) :
+        if self.seconds[ engine ] == 0.0 :
+            return float( "inf" )
+        return self.nb_reads / self.seconds[ engine ]
+
+
+def compare_engines( selectors, chunks, on_chunk=None, max_disagreements=100 ) :
+    """
+    Give every read of chunks (see read_chunks) to each selector and return a Comparison.
+    on_chunk( chunk, indexes_by_engine ) is called for each chunk if it is not None,
+    an index is the position of the chosen tag or -1 for *.
+    """
+    comparison = Comparison( len( selectors ), max_disagreements )
+    for chunk in chunks :
+        indexes_by_engine = []
+        for engine, selector in enumerate( selectors ) :
+            select = selector.select
+            start = timer()
+            lines = [ select( *sequences ) for name, sequences in chunk ]
+            comparison.seconds[ engine ] += timer() - start
+
+            indexes = [ -1 if line is None else line[1] for line in lines ]
+            comparison.assigned[ engine ] += len( indexes ) - indexes.count( -1 )
+            indexes_by_engine.append( indexes )
+
+        comparison.nb_reads += len( chunk )
+        first = indexes_by_engine[0]
+        if any( indexes != first for indexes in indexes_by_engine[ 1 : ] ) :
+            for position, ( name, sequences ) in enumerate( chunk ) :
+                row = [ indexes[ position ] for indexes in indexes_by_engine ]
+                if row.count( row[0] ) != len( row ) :
+                    comparison.nb_disagreements += 1
+                    if len( comparison.disagreements ) < max_disagreements :
+                        comparison.disagreements.append( ( name, row ) )
+
+        if on_chunk is not None :
+            on_chunk( chunk, indexes_by_engine )
+
+    return comparison
+
+
+def parse_user_argument() :
+    """
+    Get user argument.
+    """
+    import argparse
+    parser = argparse.ArgumentParser( formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__ )
+    parser.add_argument( 'file_adapt', metavar="FILE_TAG", nargs=1, type=argparse.FileType('r') )
+
+    parser.add_argument( '-f', '--fastq_1', dest="fastq_1", action='store', required=True,
+                            help="single-end file or paired-end file 1" )
+
+    parser.add_argument( '-F', '--fastq_2', dest="fastq_2", action='store', default=None,
+                            help="paired-end file 2" )
+
+    parser.add_argument( '-i', '--interleaved', dest="interleaved", action='store_true',
+                            help="paired-end reads are interleaved in the file given with -f" )
+
+    parser.add_argument( '-e', '--engine', dest="engines", action='append', default=[],
+                            help="selector to compare, give at least two engines" )
+
+    parser.add_argument( '-o', '--output', dest="output", action='store', default=None,
+                            help="write the tag chosen by each engine for every read in OUTPUT, tab separated" )
+
+    parser.add_argument( '-n', '--max-disagreements', dest="max_disagreements", action='store', type=int, default=20,
+                            help="number of disagreements printed" )
+
+    user_args = parser.parse_args()
+    if len( user_args.engines ) < 2 :
+        parser.error( "argument -e/--engine: give at least two engines" )
+
+    if user_args.interleaved and user_args.fastq_2 :
+        parser.error( "argument -i/--interleaved: not allowed with argument -F/--fastq_2" )
+
+    user_args.file_adapt = user_args.file_adapt[0]
+    user_args.single_end = user_args.fastq_2 is None and not user_args.interleaved
+    return user_args
+
+
+def main() :
+    user_args = parse_user_argument()
+
+    tag_lines = read_tag_file( user_args.file_adapt )
+    user_args.file_adapt.close()
+    tags = sorted( adapt for adapt, name in tag_lines if adapt[0] != '*' )
+    names = tags + [ '*' ]
+
+    try :
+        selectors = [ make_engine( spec, tags, user_args.single_end ) for spec in user_args.engines ]
+    except ( ValueError, ImportError ) as error :
+        print("Error: %s" % error, file=sys.stderr)
+        sys.exit( 1 )
+
+    on_chunk = None
+    if user_args.output :
+        output = open( user_args.output, "w" )
+        output.write( "\t".join( [ "read" ] + user_args.engines ) + "\n" )
+
+        def on_chunk( chunk, indexes_by_engine ) :
+            for ( name, sequences ), row in zip( chunk, zip( *indexes_by_engine ) ) :
+                output.write( "\t".join( [ name ] + [ names[ index ] for index in row ] ) + "\n" )
+
+    reads = lane_reads( ( user_args.fastq_1, user_args.fastq_2 ), user_args.interleaved )
+    try :
+        comparison = compare_engines( selectors, read_chunks( reads ), on_chunk, user_args.max_disagreements )
+    except ValueError as error :
+        print("Error: %s" % error, file=sys.stderr)
+        sys.exit( 1 )
+
+    if user_args.output :
+        output.close()
+
+    for name, row in comparison.disagreements :
+        print( "%s\t%s" % ( name, "\t".join( "%s=%s" % ( spec, names[ index ] )
+                                              for spec, index in zip( user_args.engines, row ) ) ) )
+
+    print( "%d reads, %d disagreements" % ( comparison.nb_reads, comparison.nb_disagreements ) )
+    for engine, spec in enumerate( user_args.engines ) :
+        print( "%-32s %10d reads with a tag %12.0f reads/s" % ( spec, comparison.assigned[ engine ],
+                                                                 comparison.reads_per_second( engine ) ) )
+
+    if comparison.nb_disagreements :
+        sys.exit( 1 )
+
+
+if __name__ == '__main__':
+    main()
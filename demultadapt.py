@@ -21,6 +21,10 @@ TAG_FILE format
                 *        trash
 
             You can use same output file for several tags as forwards and reverse tag with same output file.
+
+INTERLEAVED paired-end
+            With --interleaved, FASTQ_1 contains mate 1 and mate 2 of each pair one after the other,
+            and each tag has only one output file PREFIX-NAME.fastq written in the same way.
 """
 from __future__ import print_function
 
@@ -33,24 +37,12 @@ except ImportError:
      izip = zip
 
 from bisect import bisect_left
+import heapq
 
-try:
-    import Levenshtein
-except ImportError:
-    LEVENSHTEIN_IS_ENABLE = False
-else:
-    LEVENSHTEIN_IS_ENABLE = True
+# Levenshtein is imported when it is needed, it is only required by -l and -a.
 
 
-class FastqFileType( object ) :
-    """
-    Fastq file factory
-    """
-    def __init__( self, mode ) :
-        self.mode = mode
-
-    def __call__( self, path_name) :
-        return Fastq_file( path_name, self.mode )
+SELECTOR_EVENTS = ( 'exact', 'early_exit', 'fuzzy', 'tie', 'below_rate', 'default' )
 
 
 class Selector( object ) :
@@ -59,6 +51,8 @@ class Selector( object ) :
     When you call select method, this class select an output depending the sequence.
     You must implement __single_select and __paired_select method when subclassing this class.
     """
+    events = None
+
     def __init__(self, tags_table, single_end) :
         """
         tags_table - see make_tag_table.
@@ -71,6 +65,28 @@ class Selector( object ) :
         else :
             self.select = self._paired_select
 
+    def count_events( self ) :
+        """
+        Count selector events in self.events (see SELECTOR_EVENTS):
+            exact      - a read (pair) starts exactly with a tag (Std_selector)
+            early_exit - Levenshtein ratio of 1.0, other tags are not compared
+            fuzzy      - a single tag has the best ratio greater than or equal to rate
+            tie        - the best ratio is reached by several tags or by different tags for each member
+            below_rate - the best ratio is lower than rate
+            default    - no tag is selected, the read goes to the * file
+        """
+        self.events = dict.fromkeys( SELECTOR_EVENTS, 0 )
+        events = self.events
+        select = self.select
+
+        def counted_select( *sequences ) :
+            line = select( *sequences )
+            if line is None :
+                events[ 'default' ] += 1
+            return line
+
+        self.select = counted_select
+
     def _single_select( self, sequence ) :
         """
         Search line in the tags_table with a sequence
@@ -84,45 +100,201 @@ class Selector( object ) :
         raise NotImplementedError
 
 
+class TagIndex( object ) :
+    """
+    Structures depending only on the tags of a tags_table, computed once for all reads:
+
+        tags     - tags in tags_table order.
+        exact    - { tag : [ index in tags_table, ... ] }
+        lengths  - sorted lengths of tags, without duplicate.
+        groups   - [ [ ( index, tag ), ... ], ... ] tags having the length lengths[ i ] are in groups[ i ].
+        group_of - group_of[ index ] is the position in groups of the tag at index in tags_table.
+        neighbours - neighbours[ index ] is ( ratio, other index ) for the nearest other tag,
+                     None until compute_neighbours or load_neighbours is called.
+
+    A read is sliced once by length and each slice is compared to all tags of the group.
+    """
+    neighbours = None
+
+    def __init__( self, tags ) :
+        self.tags = list( tags )
+        self.exact = {}
+        for index, adaptator in enumerate( self.tags ) :
+            self.exact.setdefault( adaptator, [] ).append( index )
+
+        self.lengths = sorted( set( len( adaptator ) for adaptator in self.tags ) )
+        position_by_length = dict( ( length, position ) for position, length in enumerate( self.lengths ) )
+        self.groups = [ [] for length in self.lengths ]
+        self.group_of = []
+        for index, adaptator in enumerate( self.tags ) :
+            position = position_by_length[ len( adaptator ) ]
+            self.groups[ position ].append( ( index, adaptator ) )
+            self.group_of.append( position )
+
+    def compute_neighbours( self ) :
+        from Levenshtein import ratio
+        self.neighbours = [ ( 0.0, -1 ) ] * len( self.tags )
+        for index, adaptator in enumerate( self.tags ) :
+            for other_index in range( index + 1, len( self.tags ) ) :
+                dist = ratio( adaptator, self.tags[ other_index ] )
+                if dist > self.neighbours[ index ][ 0 ] :
+                    self.neighbours[ index ] = ( dist, other_index )
+                if dist > self.neighbours[ other_index ][ 0 ] :
+                    self.neighbours[ other_index ] = ( dist, index )
+
+    def __len__( self ) :
+        return len( self.tags )
+
+
 class Levenshtein_selector( Selector ) :
+    """
+    Select the tag with the best Levenshtein ratio greater than or equal to rate.
+
+    Ratios are not computed when a read (member) starts exactly with a tag, and for tags
+    which are too long to reach rate against a shorter read (see _cannot_reach). On reads
+    longer than the tags, a read without exact match is compared with every tag: a lower
+    bound from base counts was measured slower than Levenshtein.ratio on tag-sized strings.
+    """
     tags_table = None
     single_end = False
     rate = 0
-    def __init__( self, tags_table, single_end, rate ) :
+    def __init__( self, tags_table, single_end, rate, tag_index=None ) :
+        """
+        tag_index - TagIndex of tags_table, computed if it is None.
+        """
         if not isinstance( rate, float ) :
             raise ValueError( "rate argument must be a float not %s" % type( rate ) )
         Selector.__init__( self, tags_table, single_end)
         self.rate = rate
 
-    def _single_select( self, sequence) :
         from Levenshtein import ratio
+        self._ratio = ratio
+
+        if tag_index is None :
+            tag_index = TagIndex( line[ 0 ] for line in tags_table )
+        self.tag_index = tag_index
+
+        # A read shorter than _min_sizes[ i ] can't reach rate with tags of groups[ i ] (see _cannot_reach).
+        self._min_sizes = []
+        for length in tag_index.lengths :
+            size = 0
+            while size < length and self._cannot_reach( length, size, rate ) :
+                size += 1
+            self._min_sizes.append( size )
+
+    def _prefixes( self, sequence ) :
+        """
+        Return the start of sequence for each length of tags.
+        """
+        return [ sequence[ : length ] for length in self.tag_index.lengths ]
 
-        distances = []
-        for (adaptator, output_file) in self.tags_table :
-            dist = ratio( adaptator, sequence[ : len( adaptator ) ] )
-            if dist == 1.0 :
-                return (adaptator, output_file)
+    def _exact_matches( self, prefixes, size ) :
+        """
+        Return indexes in tags_table of tags starting a sequence of size bases, in tags_table order.
+        prefixes - see _prefixes.
+        """
+        indexes = []
+        exact = self.tag_index.exact
+        for length, prefix in zip( self.tag_index.lengths, prefixes ) :
+            if length > size :
+                break
+            found = exact.get( prefix )
+            if found is not None :
+                indexes.extend( found )
+
+        if len( indexes ) > 1 :
+            indexes.sort()
+        return indexes
+
+    def _distances( self, prefixes, size ) :
+        """
+        Return the ratio between each tag of tags_table and the start of a sequence of size bases.
 
-            distances.append( dist )
+        When the sequence is too short for the tags of a group to reach rate (see _cannot_reach)
+        their ratio are not computed and 0.0 is returned.
+        """
+        ratio = self._ratio
+        distances = [ 0.0 ] * len( self.tag_index )
+        for group, prefix, min_size in zip( self.tag_index.groups, prefixes, self._min_sizes ) :
+            if size >= min_size :
+                for index, adaptator in group :
+                    distances[ index ] = ratio( adaptator, prefix )
+        return distances
+
+    @staticmethod
+    def _cannot_reach( length, size, threshold ) :
+        """
+        Return True if a tag of length bases can't have a ratio greater than or equal to threshold
+        against a sequence of size bases. ratio is 1 - indels / ( length + size ) and there are
+        at least length - size indels. The margin keeps ratios rounded differently by Levenshtein.
+        """
+        return 2.0 * size / ( length + size ) < threshold - 1e-9
 
+    def _single_select( self, sequence) :
+        prefixes = self._prefixes( sequence )
+        exact = self._exact_matches( prefixes, len( sequence ) )
+        if exact :
+            if self.events is not None :
+                self.events[ 'early_exit' ] += 1
+            return self.tags_table[ exact[ 0 ] ]
+
+        distances = self._distances( prefixes, len( sequence ) )
         max_dist = max( distances )
         if max_dist >= self.rate and distances.count( max_dist ) == 1 :
+            if self.events is not None :
+                self.events[ 'fuzzy' ] += 1
             return self.tags_table[ distances.index( max_dist ) ]
 
+        if self.events is not None :
+            self.events[ 'tie' if max_dist >= self.rate else 'below_rate' ] += 1
         return None
 
     def _paired_select( self, sequence_1, sequence_2) :
-        from Levenshtein import ratio
-        distances_1 = []
-        distances_2 = []
+        prefixes_1 = self._prefixes( sequence_1 )
+        prefixes_2 = self._prefixes( sequence_2 )
+        exact_1 = self._exact_matches( prefixes_1, len( sequence_1 ) )
+        exact_2 = self._exact_matches( prefixes_2, len( sequence_2 ) )
+        if exact_1 or exact_2 :
+            line = self._best_of_exact_pair( exact_1, exact_2 )
+            if self.events is not None :
+                self.events[ 'tie' if line is None else 'early_exit' ] += 1
+            return line
+
+        distances_1 = self._distances( prefixes_1, len( sequence_1 ) )
+        distances_2 = self._distances( prefixes_2, len( sequence_2 ) )
+
+        line = self._best_of_pair( distances_1, distances_2 )
+        if self.events is not None :
+            self._count_paired_event( line, max( max( distances_1 ), max( distances_2 ) ) )
+        return line
+
+    def _best_of_exact_pair( self, exact_1, exact_2 ) :
+        """
+        Same as _best_of_pair when a member at least starts with a tag,
+        exact_1 and exact_2 are indexes of tags with a ratio of 1.0 (see _exact_matches).
+        """
+        if self.rate > 1.0 :
+            return None
 
-        for line in self.tags_table :
-            adaptator = line[ 0 ]
-            dist_1 = ratio( adaptator, sequence_1[ : len( adaptator ) ] )
-            dist_2 = ratio( adaptator, sequence_2[ : len( adaptator ) ] )
-            distances_1.append( dist_1 )
-            distances_2.append( dist_2 )
+        if not exact_2 :
+            if len( exact_1 ) == 1 :
+                return self.tags_table[ exact_1[ 0 ] ]
 
+        elif not exact_1 :
+            if len( exact_2 ) == 1 :
+                return self.tags_table[ exact_2[ 0 ] ]
+
+        elif ( len( exact_1 ) == 1 or len( exact_2 ) == 1 ) and exact_1[ 0 ] == exact_2[ 0 ] :
+            return self.tags_table[ exact_1[ 0 ] ]
+
+        return None
+
+    def _best_of_pair( self, distances_1, distances_2 ) :
+        """
+        Choose a line of tags_table with the ratios of each member of a pair.
+        The member with the best ratio gives the tag, if both members have the same
+        best ratio, they must agree.
+        """
         max_dist_1 = max( distances_1 )
         max_dist_2 = max( distances_2 )
 
@@ -150,58 +322,124 @@ class Levenshtein_selector( Selector ) :
 
         return None
 
+    def _count_paired_event( self, line, max_dist ) :
+        """
+        max_dist - the best ratio which had to reach rate.
+        """
+        if line is not None :
+            self.events[ 'fuzzy' ] += 1
+        elif max_dist >= self.rate :
+            self.events[ 'tie' ] += 1
+        else :
+            self.events[ 'below_rate' ] += 1
+
 
 class LevenshteinAllSelector( Levenshtein_selector ) :
     """
     Levenshtein_selector with paired-end way, Two member sequence of paired-end must be greater or equal to
     rate min and have same tags.
+
+    Member 2 is only compared with all tags when member 1 has a unique best tag, and the
+    comparison stops as soon as another tag is as good as this one (see _unique_best_at).
     """
 
     def _paired_select( self, sequence_1, sequence_2) :
-        from Levenshtein import ratio
-        distances_1 = []
-        distances_2 = []
+        index, max_dist_1 = self._unique_best( sequence_1 )
+        if index is None :
+            if self.events is not None :
+                self.events[ 'tie' if max_dist_1 >= self.rate else 'below_rate' ] += 1
+            return None
 
-        for line in self.tags_table :
-            adaptator = line[ 0 ]
-            dist_1 = ratio( adaptator, sequence_1[ : len( adaptator ) ] )
-            dist_2 = ratio( adaptator, sequence_2[ : len( adaptator ) ] )
-            distances_1.append( dist_1 )
-            distances_2.append( dist_2 )
+        max_dist_2 = self._unique_best_at( sequence_2, index )
+        if max_dist_2 is None :
+            if self.events is not None :
+                self.events[ 'tie' ] += 1
+            return None
 
-        max_dist_1 = max( distances_1 )
-        max_dist_2 = max( distances_2 )
+        if max_dist_2 < self.rate :
+            if self.events is not None :
+                self.events[ 'below_rate' ] += 1
+            return None
 
-        if ( max_dist_1 >= self.rate and max_dist_2 >= self.rate
-           and distances_1.count( max_dist_1 ) == distances_2.count( max_dist_2 ) == 1 ) :
-               adapt_1 = self.tags_table[ distances_1.index( max_dist_1 ) ]
-               adapt_2 = self.tags_table[ distances_2.index( max_dist_2 ) ]
-               if adapt_1 == adapt_2 :
-                    return adapt_1
-        else :
+        if self.events is not None :
+            self.events[ 'early_exit' if max_dist_1 == max_dist_2 == 1.0 else 'fuzzy' ] += 1
+        return self.tags_table[ index ]
+
+    def _unique_best( self, sequence ) :
+        """
+        Return ( index, best ratio ), index is the index in tags_table of the only tag
+        having the best ratio greater than or equal to rate, else None.
+        """
+        prefixes = self._prefixes( sequence )
+        exact = self._exact_matches( prefixes, len( sequence ) )
+        if exact :
+            if len( exact ) == 1 and 1.0 >= self.rate :
+                return exact[ 0 ], 1.0
+            return None, 1.0
+
+        distances = self._distances( prefixes, len( sequence ) )
+        max_dist = max( distances )
+        if max_dist >= self.rate and distances.count( max_dist ) == 1 :
+            return distances.index( max_dist ), max_dist
+        return None, max_dist
+
+    def _unique_best_at( self, sequence, index ) :
+        """
+        Return the ratio between sequence and the tag at index if no other tag has a ratio
+        greater than or equal to it, else None. Stop as soon as the ratio is lower than rate
+        or another tag is as good.
+        """
+        tag_index = self.tag_index
+        prefixes = self._prefixes( sequence )
+        dist = self._ratio( tag_index.tags[ index ], prefixes[ tag_index.group_of[ index ] ] )
+        if dist < self.rate :
+            return dist
+
+        size = len( sequence )
+        if dist == 1.0 :
+            if self._exact_matches( prefixes, size ) == [ index ] :
+                return dist
             return None
 
+        ratio = self._ratio
+        for length, group, prefix in zip( tag_index.lengths, tag_index.groups, prefixes ) :
+            if length > size and self._cannot_reach( length, size, dist ) :
+                break
+            for other_index, other in group :
+                if other_index != index and ratio( other, prefix ) >= dist :
+                    return None
+        return dist
+
+
 class Std_selector( Selector ):
     """
     Search in the tags_table, sequence start must be identical to tag not similar.
     """
 
     def _paired_select( self, sequence_1, sequence_2):
-        l1 = self._single_select( sequence_1 )
-        l2 = self._single_select( sequence_2 )
-        if l1 is None :
-            return l2
-
-        if l2 is None :
-            return l1
-
-        if l1 == l2 :
-            return l1
-
+        l1 = self._search( sequence_1 )
+        l2 = self._search( sequence_2 )
+        if l1 is None or l2 is None or l1 == l2 :
+            line = l2 if l1 is None else l1
+            if line is not None and self.events is not None :
+                self.events[ 'exact' ] += 1
+            return line
+
+        if self.events is not None :
+            self.events[ 'tie' ] += 1
         return None
 
 
     def _single_select( self, sequence):
+        line = self._search( sequence )
+        if line is not None and self.events is not None :
+            self.events[ 'exact' ] += 1
+        return line
+
+    def _search( self, sequence ) :
+        """
+        Binary search of the tag starting sequence, events are counted by the callers.
+        """
         a = 0
         b = len( self.tags_table ) -1
         if b == -1 :
@@ -224,52 +462,378 @@ class Std_selector( Selector ):
         return None
 
 
-def get_adapt_counter( opened_adapt_file ) :
+class SamplingProfiler( object ) :
     """
-    return { tag1 : 0,
-             tag2 : 0,
-             ...
-             tagN : 0 }
+    Sample the python stack every interval seconds of CPU time with SIGPROF.
+    Samples are counted by stack and written in the folded format of
+    flamegraph.pl ( frame_1;frame_2;...;frame_n count ).
+    Time spent in C functions (Levenshtein.ratio, file.write...) is given to the python caller.
     """
-    d = {}
-    opened_adapt_file.seek(0)
+    def __init__( self, interval=0.005 ) :
+        self.interval = interval
+        self.stacks = {}
+        self.nb_samples = 0
+
+    def _sample( self, signum, frame ) :
+        frames = []
+        while frame is not None :
+            code = frame.f_code
+            frames.append( "%s:%s" % ( os.path.basename( code.co_filename ), code.co_name ) )
+            frame = frame.f_back
+
+        frames.reverse()
+        stack = ";".join( frames )
+        self.stacks[ stack ] = self.stacks.get( stack, 0 ) + 1
+        self.nb_samples += 1
+
+    def start( self ) :
+        import signal
+        if not hasattr( signal, "setitimer" ) :
+            raise RuntimeError( "profiling needs signal.setitimer which is not available on this platform" )
+        signal.signal( signal.SIGPROF, self._sample )
+        signal.setitimer( signal.ITIMER_PROF, self.interval, self.interval )
+
+    def stop( self ) :
+        import signal
+        signal.setitimer( signal.ITIMER_PROF, 0 )
+        signal.signal( signal.SIGPROF, signal.SIG_DFL )
+
+    def write_folded( self, path ) :
+        """
+        Write stacks for flamegraph.pl in path.
+        """
+        with open( path, "w" ) as folded_file :
+            for stack, nb in sorted( self.stacks.items() ) :
+                folded_file.write( "%s %d\n" % ( stack, nb ) )
+
+    def print_summary( self, events=None, out=sys.stderr, top=10 ) :
+        """
+        Print the functions where the most samples end and the selector events.
+        """
+        by_function = {}
+        for stack, nb in self.stacks.items() :
+            function = stack.rsplit( ";", 1 )[ -1 ]
+            by_function[ function ] = by_function.get( function, 0 ) + nb
+
+        print( "Profile: %d samples every %g s" % ( self.nb_samples, self.interval ), file=out )
+        ranking = sorted( by_function.items(), key=lambda item: item[1], reverse=True )
+        for function, nb in ranking[ : top ] :
+            print( "  %6.2f%% %s" % ( 100.0 * nb / max( self.nb_samples, 1 ), function ), file=out )
+
+        if events is not None :
+            print( "Selector events:", file=out )
+            for event in SELECTOR_EVENTS :
+                print( "  %-10s %d" % ( event, events[ event ] ), file=out )
+
+
+class SpaceSaving( object ) :
+    """
+    Count the most frequent items of a stream in bounded memory (Space-Saving algorithm).
+
+    At most capacity items are counted. A new item replaces the item having the smallest
+    count and takes its count + 1, the replaced count is kept as the error of the new item.
+    Every item seen more than n / capacity times among n is counted.
+    The sample given with the first add of a counted item is kept in samples.
+    """
+    def __init__( self, capacity ) :
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.samples = {}
+        # ( count, item ) for each counted item, count may be lower than the real count.
+        self._heap = []
+
+    def add( self, item, sample=None ) :
+        counts = self.counts
+        if item in counts :
+            counts[ item ] += 1
+
+        elif len( counts ) < self.capacity :
+            counts[ item ] = 1
+            self.errors[ item ] = 0
+            self.samples[ item ] = sample
+            heapq.heappush( self._heap, ( 1, item ) )
+
+        else :
+            heap = self._heap
+            count, victim = heap[ 0 ]
+            while counts[ victim ] != count :
+                heapq.heapreplace( heap, ( counts[ victim ], victim ) )
+                count, victim = heap[ 0 ]
+
+            del counts[ victim ]
+            del self.errors[ victim ]
+            del self.samples[ victim ]
+            counts[ item ] = count + 1
+            self.errors[ item ] = count
+            self.samples[ item ] = sample
+            heapq.heapreplace( heap, ( count + 1, item ) )
+
+    def top( self, k ) :
+        """
+        Return [ ( item, count, error ), ... ] for the k most frequent items,
+        the real count is between count - error and count.
+        """
+        ranking = sorted( self.counts.items(), key=lambda item_count: ( -item_count[1], item_count[0] ) )
+        return [ ( item, count, self.errors[ item ] ) for item, count in ranking[ : k ] ]
+
+
+class MemoryBudget( object ) :
+    """
+    Memory shared by output buffers (see BufferedFastqFile).
+    When more than max_bytes are buffered, the largest buffers are written first
+    until half of max_bytes is used.
+    """
+    def __init__( self, max_bytes, reserved=0 ) :
+        """
+        reserved - bytes used outside the buffers (file objects, read chunks...), counted in peak.
+        """
+        self.max_bytes = max_bytes
+        self.reserved = reserved
+        self.used = 0
+        self.peak = 0
+        self.buffers = []
+
+    def release( self ) :
+        for buffered in sorted( self.buffers, key=lambda buffered: buffered.size, reverse=True ) :
+            if self.used <= self.max_bytes // 2 :
+                break
+            buffered.flush()
+
+    def get_peak( self ) :
+        """
+        Return the maximal number of bytes used by buffers and reserved.
+        """
+        return self.peak + self.reserved
+
+
+class BufferedFastqFile( object ) :
+    """
+    Keep reads written in a Fastq_file in memory, in the limit of a MemoryBudget.
+    """
+    def __init__( self, fastq_file, budget ) :
+        self.fastq_file = fastq_file
+        self.budget = budget
+        self.texts = []
+        self.size = 0
+        budget.buffers.append( self )
+
+    def write( self, seq ) :
+        self.texts.append( seq )
+        self.size += len( seq )
+        budget = self.budget
+        budget.used += len( seq )
+        if budget.used > budget.peak :
+            budget.peak = budget.used
+        if budget.used > budget.max_bytes :
+            budget.release()
+
+    def flush( self ) :
+        if self.texts :
+            self.fastq_file.write( "\n".join( self.texts ) )
+            self.budget.used -= self.size
+            self.texts = []
+            self.size = 0
+
+    def close( self ) :
+        self.flush()
+        self.fastq_file.close()
+
+
+def parse_size( size ) :
+    """
+    Return the number of bytes of a size as 1000, 512K, 300M or 2G.
+    """
+    units = { "K" : 1024, "M" : 1024 ** 2, "G" : 1024 ** 3 }
+    size = size.strip().upper().rstrip( "B" )
+    if size and size[-1] in units :
+        return int( float( size[ : -1 ] ) * units[ size[-1] ] )
+    return int( size )
+
+
+def estimate_read_size( lane, interleaved=False ) :
+    """
+    Return an estimation of the memory used by a read (pair) of lane, from its first read.
+    """
+    try :
+        for str_reads in lane_reads( lane, interleaved ) :
+            # str objects, tuples and pickling roughly double the text.
+            return 2 * sum( len( str_read ) + 64 for str_read in str_reads )
+    except ValueError :
+        # the error is given when the lane is demultiplexed.
+        pass
+    return 1
+
+
+def nearest_tag( sequence, tags ) :
+    """
+    Return ( tag, ratio ) for the tag of tags the most similar to the start of sequence.
+    Levenshtein ratio is used if python-Levenshtein is installed else the rate of identical bases.
+    """
+    try :
+        from Levenshtein import ratio
+    except ImportError :
+        def ratio( adaptator, start_seq ) :
+            same = sum( 1 for base_1, base_2 in izip( adaptator, start_seq ) if base_1 == base_2 )
+            return float( same ) / max( len( adaptator ), len( start_seq ), 1 )
+
+    best_tag, best_dist = None, -1.0
+    for adaptator in tags :
+        dist = ratio( adaptator, sequence[ : len( adaptator ) ] )
+        if dist > best_dist :
+            best_tag, best_dist = adaptator, dist
+    return best_tag, best_dist
+
+
+def add_trash_starts( trash_prefixes, starts, key_length ) :
+    """
+    Count the starts of a read (pair) written in the * file.
+    trash_prefixes - SpaceSaving of tuples with the first key_length bases of each member,
+                     starts are kept as sample for nearest_tag.
+    starts - the start of each member, see select_reads.
+    """
+    trash_prefixes.add( tuple( start[ : key_length ] for start in starts ), starts )
+
+
+def trash_prefix_lengths( tags ) :
+    """
+    Return ( key_length, prefix_length ) for the trash report (see add_trash_starts):
+    reads are counted by their first bases on the length of the shortest tag, so that
+    an unknown tag is counted whatever follows it, and the length of the longest tag
+    is kept to find the nearest tag. Without tag, 6 bases are counted, less than most barcodes.
+    """
+    if not tags :
+        return 6, 6
+    lengths = [ len( adapt ) for adapt in tags ]
+    return min( lengths ), max( lengths )
+
+
+def print_trash_report( trash_prefixes, tags, k, out=sys.stdout ) :
+    """
+    Print the k most frequent starts of reads written in the * file and their nearest tag.
+    trash_prefixes - SpaceSaving filled by add_trash_starts.
+    """
+    print( "Most frequent starts of reads without tag:", file=out )
+    for prefixes, count, error in trash_prefixes.top( k ) :
+        line = "  %s %d reads (+/- %d)" % ( " ".join( prefixes ), count, error )
+        if tags :
+            nearest = [ "%s (%.2f)" % nearest_tag( start, tags ) for start in trash_prefixes.samples[ prefixes ] ]
+            line += "   nearest tag %s" % " ".join( nearest )
+        print( line, file=out )
+
+
+def read_tag_file( opened_adapt_file, need_default=True ) :
+    """
+    Read the tag file once and return its lines:
+        [ ( tag1, name1 ),
+          ( tag2, name2 ),
+          ...
+          ( '*', trash_name ) ]
+    need_default - exit if the file has no line with the * tag, it is needed to demultiplex.
+    """
+    tag_lines = []
+    has_default = False
     for line in opened_adapt_file :
         if not line.isspace() :
             try :
-                adapt, name_tag = line.split()
+                adapt, suffix_file = line.split()
             except ValueError :
-                print("Error '%s' is an invalid file format." %  opened_adapt_file.name,
+                print("Error: '%s' is an invalid file format." %  opened_adapt_file.name,
                       file=sys.stderr)
-                exit( 1 )
-            d[ adapt ] = [ name_tag, 0 ]
-    return d
+                sys.exit( 1 )
 
+            has_default = has_default or adapt[0] == '*'
+            tag_lines.append( ( adapt, suffix_file ) )
 
-def get_maximal_annalogie( file_adapt ) :
-    """
-    Compute the max Levenshtein rate between tags.
-    """
-    from Levenshtein import ratio
-    adaptators = []
-    for line in file_adapt :
-        if line :
-            (adapt, name) = line.split()
-            if adapt != "*" :
-                adaptators.append( adapt )
+    if need_default and not has_default :
+        print("Le fichier '%s' n'a pas de ligne avec le tag jocker *.\nAjouter une ligne '*    tag_name'." %  opened_adapt_file.name, file=sys.stderr)
+        sys.exit(1)
 
-    ratio_max = 0.0
-    for i, adapt in enumerate( adaptators ) :
-        for adapt2 in adaptators[i+1:] :
-            ratio_max = max( ratio_max,ratio( adapt, adapt2 ) )
+    return tag_lines
 
-    return ratio_max
 
+def load_neighbours( tag_index, tag_file_name ) :
+    """
+    Set tag_index.neighbours (see TagIndex) from the cache TAG_FILE.idx, or compute them
+    and write the cache. The cache has a hash of the tags, it is used while they are not modified.
+    """
+    import hashlib
+    import marshal
+
+    key = hashlib.sha1( repr( tag_index.tags ).encode( "utf-8" ) ).hexdigest()
+    cache_name = tag_file_name + ".idx"
+    try :
+        with open( cache_name, "rb" ) as cache_file :
+            cached_key, neighbours = marshal.load( cache_file )
+        if cached_key == key and len( neighbours ) == len( tag_index ) :
+            tag_index.neighbours = [ tuple( neighbour ) for neighbour in neighbours ]
+            return
+    except ( IOError, OSError, EOFError, ValueError, TypeError ) :
+        pass
+
+    tag_index.compute_neighbours()
+    # The cache is shared by concurrent runs: it is written in a temporary file
+    # renamed at the end, so a reader never sees a partial cache.
+    import tempfile
+    try :
+        fd, tmp_name = tempfile.mkstemp( prefix=os.path.basename( cache_name ) + ".",
+                                         dir=os.path.dirname( cache_name ) or "." )
+    except ( IOError, OSError ) :
+        return
+    try :
+        with os.fdopen( fd, "wb" ) as cache_file :
+            marshal.dump( ( key, tag_index.neighbours ), cache_file )
+        getattr( os, "replace", os.rename )( tmp_name, cache_name )
+    except ( IOError, OSError ) :
+        try :
+            os.remove( tmp_name )
+        except OSError :
+            pass
+
+
+def get_adapt_counter( tag_lines ) :
+    """
+    return { tag1 : [ name1, 0 ],
+             tag2 : [ name2, 0 ],
+             ...
+             tagN : [ nameN, 0 ] }
+    """
+    d = {}
+    for adapt, name_tag in tag_lines :
+        d[ adapt ] = [ name_tag, 0 ]
+    return d
 
 
+def merge_lane_counts( tag_lines, tags, counts_by_lane ) :
+    """
+    Return ( [ counter of each lane ], counter of all lanes ), counters are given by get_adapt_counter.
+    counts_by_lane - counts_by_lane[ lane ][ index ] is the number of reads written for tags[ index ],
+                     the last count is for *.
+    """
+    nb_reads_writen = get_adapt_counter( tag_lines )
+    nb_reads_by_lane = []
+    for counts in counts_by_lane :
+        nb_reads = get_adapt_counter( tag_lines )
+        for adapt, nb in zip( tags + [ '*' ], counts ) :
+            nb_reads[ adapt ][1] += nb
+            nb_reads_writen[ adapt ][1] += nb
+        nb_reads_by_lane.append( nb_reads )
+    return nb_reads_by_lane, nb_reads_writen
+
+
+def get_maximal_annalogie( tag_index ) :
+    """
+    Compute the max Levenshtein rate between tags.
+    """
+    if tag_index.neighbours is None :
+        tag_index.compute_neighbours()
+    return max( [ 0.0 ] + [ dist for dist, other_index in tag_index.neighbours ] )
 
-def make_tag_table( opened_adapt_file, prefix, paired_end=True ) :
+
+def make_tag_table( tag_lines, prefix, paired_end=True, interleaved=False ) :
     """
     Return the output file list (tag_table) and trash_file.
+    tag_lines - see read_tag_file.
 
     When paired_end is True, the tag_table format is:
 
@@ -279,6 +843,9 @@ def make_tag_table( opened_adapt_file, prefix, paired_end=True ) :
 
         return ( tag_table, (trash_file_1, trash_file_2) )
 
+        If interleaved is True, output_file_X_1 and output_file_X_2 are the
+        same PREFIX-NAME.fastq file.
+
     else:
         [ (tagA, output_file_A ),
           (tagB, output_file_B ),
@@ -291,17 +858,20 @@ def make_tag_table( opened_adapt_file, prefix, paired_end=True ) :
     default = None
     cache_name_file_by_adapt = {}
 
-    for line in opened_adapt_file :
-        if not line.isspace() :
-                try :
-                    adapt, suffix_file = line.split()
-                except ValueError :
-                    print("Error: '%s' is an invalid file format." %  opened_adapt_file.name,
-                          file=sys.stderr)
-                    exit( 1 )
-
-                if paired_end :
-                    if line[0] == '*' :
+    for adapt, suffix_file in tag_lines :
+                if paired_end and interleaved :
+                    if suffix_file not in cache_name_file_by_adapt :
+                        f = Fastq_file( "%s-%s.fastq" % (prefix, suffix_file), "w" )
+                        cache_name_file_by_adapt[ suffix_file ] = (f, f)
+
+                    if adapt[0] == '*' :
+                        default = cache_name_file_by_adapt[ suffix_file ]
+                    else :
+                        f1, f2 = cache_name_file_by_adapt[ suffix_file ]
+                        ada_files.append( ( adapt, f1, f2 ) )
+
+                elif paired_end :
+                    if adapt[0] == '*' :
                         default = ( Fastq_file( "%s-%s_1.fastq" % (prefix, suffix_file), "w" ),
                                     Fastq_file( "%s-%s_2.fastq" % (prefix, suffix_file), "w" ), )
 
@@ -319,7 +889,7 @@ def make_tag_table( opened_adapt_file, prefix, paired_end=True ) :
 
                 else :
                     # TODO faire le system de cache pour le mode single.
-                    if line[0] == '*' :
+                    if adapt[0] == '*' :
                         default = ( Fastq_file( "%s-%s.fastq" % (prefix, suffix_file), "w" ) , )
 
                     else :
@@ -329,14 +899,251 @@ def make_tag_table( opened_adapt_file, prefix, paired_end=True ) :
                                            )
                         )
 
-    if default is None :
-        print("Le fichier '%s' n'a pas de ligne avec le tag jocker *.\nAjouter une ligne '*    tag_name'." %  opened_adapt_file.name, file=sys.stderr)
-        sys.exit(1)
-
     ada_files.sort()
     return ada_files, default
 
 
+def iter_interleaved( fastq_file ) :
+    """
+    Yield ( str_read_1, str_read_2 ) pairs from an interleaved Fastq_file.
+    Raise ValueError if the file has an odd number of reads.
+    """
+    for str_read_1 in fastq_file :
+        try :
+            str_read_2 = next( fastq_file )
+        except StopIteration :
+            raise ValueError( "'%s' has an odd number of reads, it is not an interleaved file." % fastq_file.file.name )
+        yield str_read_1, str_read_2
+
+
+def lane_reads( lane, interleaved=False ) :
+    """
+    Yield the reads of a lane.
+    lane - ( fastq_1_name, fastq_2_name ), fastq_2_name is None in single-end and interleaved mode.
+    yield ( str_read, ) in single-end else ( str_read_1, str_read_2 )
+    """
+    fastq_1 = Fastq_file( lane[0], "r" )
+    fastq_2 = None
+    try :
+        if lane[1] is not None :
+            fastq_2 = Fastq_file( lane[1], "r" )
+            for pair in izip( fastq_1, fastq_2 ) :
+                yield pair
+
+        elif interleaved :
+            for pair in iter_interleaved( fastq_1 ) :
+                yield pair
+
+        else :
+            for str_read in fastq_1 :
+                yield ( str_read, )
+    finally :
+        fastq_1.close()
+        if fastq_2 is not None :
+            fastq_2.close()
+
+
+def make_selector( tags_table, single_end, levenshtein=None, all_members=False, tag_index=None ) :
+    """
+    Return the selector chosen by the user options.
+    levenshtein - Levenshtein rate or None to select with identical tags.
+    all_members - use LevenshteinAllSelector in paired-end.
+    """
+    if levenshtein :
+        if all_members :
+            return LevenshteinAllSelector( tags_table, single_end, levenshtein, tag_index )
+        return Levenshtein_selector( tags_table, single_end, levenshtein, tag_index )
+    return Std_selector( tags_table, single_end )
+
+
+def select_reads( reads, selector, verbose=False, trash_prefix_length=0 ) :
+    """
+    Choose the output of each read (pair) and remove its tag.
+    reads - see lane_reads.
+    selector - a selector with a tags_table [ ( tag, index ), ... ].
+    yield ( index, texts, starts ), index is given by the tags_table or -1 for *,
+          texts are the reads to write, one by member,
+          starts are the first trash_prefix_length bases of each member for reads going to *
+          if trash_prefix_length is not 0, else None.
+    """
+    select = selector.select
+    for str_reads in reads :
+        if len( str_reads ) == 1 :
+            read = Fastq_read( str_reads[0] )
+            adapt_and_line = select( read.seq )
+            if adapt_and_line is None :
+                if verbose :
+                    print("Read '%s' start with %s... and go to *" % (read.name, read.seq[ : 14 ]))
+                starts = ( read.seq[ : trash_prefix_length ], ) if trash_prefix_length else None
+                yield -1, ( str( read ), ), starts
+
+            else :
+                (adapt, index) = adapt_and_line
+                if verbose :
+                    print("Read '%s' start with %s... and go to %s" % (read.name, read.seq[ : len( adapt ) ], adapt))
+
+                read.cut_start( len( adapt ) )
+                yield index, ( str( read ), ), None
+
+        else :
+            read_1 = Fastq_read( str_reads[0] )
+            read_2 = Fastq_read( str_reads[1] )
+            adapt_and_line = select( read_1.seq, read_2.seq )
+            if adapt_and_line is None :
+                starts = None
+                if trash_prefix_length :
+                    starts = ( read_1.seq[ : trash_prefix_length ], read_2.seq[ : trash_prefix_length ] )
+                yield -1, ( str( read_1 ), str( read_2 ) ), starts
+
+            else :
+                (adapt, index) = adapt_and_line
+                read_1.cut_start( len( adapt ) )
+                read_2.cut_start( len( adapt ) )
+                yield index, ( str( read_1 ), str( read_2 ) ), None
+
+
+def write_reads( selected, output_files, counts, trash_prefixes=None, key_length=0 ) :
+    """
+    Write reads chosen by select_reads.
+    output_files - output_files[ index ] are the files of each member for the tag at index,
+                   output_files[ -1 ] are the files of *.
+    counts - counts[ index ] is incremented for each read (pair) written with index.
+    trash_prefixes - SpaceSaving counting the starts of reads written in * files, or None
+                     (see add_trash_starts).
+    """
+    for index, texts, starts in selected :
+        counts[ index ] += 1
+        files = output_files[ index ]
+        files[0].write( texts[0] )
+        if len( texts ) == 2 :
+            files[1].write( texts[1] )
+
+        if starts is not None and trash_prefixes is not None :
+            add_trash_starts( trash_prefixes, starts, key_length )
+
+
+def group_reads( selected, interleaved=False ) :
+    """
+    Group reads chosen by select_reads by output, to send them to another process.
+    Return ( [ ( index, nb_reads, texts ), ... ], trash_starts ), texts are the reads of
+    each member joined with '\n', trash_starts are the starts of reads going to *
+    given by select_reads.
+    If interleaved is True, both members are written in the same file, texts has one
+    text with the reads of each pair one after the other.
+    """
+    reads_by_index = {}
+    trash_starts = []
+    for index, texts, starts in selected :
+        reads_by_index.setdefault( index, [] ).append( texts )
+        if starts is not None :
+            trash_starts.append( starts )
+
+    if interleaved :
+        groups = [ ( index, len( reads ), ( "\n".join( text for texts in reads for text in texts ), ) )
+                   for index, reads in reads_by_index.items() ]
+    else :
+        groups = [ ( index, len( reads ), tuple( "\n".join( member ) for member in izip( *reads ) ) )
+                   for index, reads in reads_by_index.items() ]
+    return groups, trash_starts
+
+
+def write_groups( groups, output_files, counts ) :
+    """
+    Write reads grouped by group_reads, see write_reads. Interleaved texts are
+    written in the first file of the output.
+    """
+    for index, nb_reads, texts in groups :
+        counts[ index ] += nb_reads
+        for output_file, text in zip( output_files[ index ], texts ) :
+            output_file.write( text )
+
+
+def demultiplex_worker( tags, selector_options, tag_index, lanes, results, interleaved, verbose,
+                        chunk_size, trash_prefix_length ) :
+    """
+    Select reads in a worker process. Lanes ( lane_number, lane ) are taken in the lanes queue
+    until None and results are put in the results queue:
+        ( lane_number, group_reads result ) for each chunk of chunk_size reads,
+        ( lane_number, None ) at the end of the lane,
+        ( lane_number, error message ) if the lane can't be demultiplexed.
+    """
+    selector = make_selector( [ ( tag, index ) for index, tag in enumerate( tags ) ], *selector_options,
+                              tag_index=tag_index )
+    for lane_number, lane in iter( lanes.get, None ) :
+        try :
+            chunk = []
+            for item in select_reads( lane_reads( lane, interleaved ), selector, verbose, trash_prefix_length ) :
+                chunk.append( item )
+                if len( chunk ) == chunk_size :
+                    results.put( ( lane_number, group_reads( chunk, interleaved ) ) )
+                    chunk = []
+
+            if chunk :
+                results.put( ( lane_number, group_reads( chunk, interleaved ) ) )
+            results.put( ( lane_number, None ) )
+
+        except Exception as error :
+            results.put( ( lane_number, "%s: %s" % ( type( error ).__name__, error ) ) )
+
+
+def demultiplex_parallel( lanes, jobs, tags, selector_options, tag_index, write, interleaved=False,
+                          verbose=False, chunk_size=10000, trash_prefix_length=0 ) :
+    """
+    Select reads of lanes in jobs worker processes. For each chunk of selected reads,
+    write( lane_number, groups, trash_starts ) (see group_reads) is called in this process,
+    so outputs are written by one process only.
+    """
+    import multiprocessing
+    try :
+        from queue import Empty
+    except ImportError :
+        from Queue import Empty
+
+    lanes_queue = multiprocessing.Queue()
+    for lane_number, lane in enumerate( lanes ) :
+        lanes_queue.put( ( lane_number, lane ) )
+
+    results = multiprocessing.Queue( 2 * jobs )
+    workers = []
+    for i in range( min( jobs, len( lanes ) ) ) :
+        lanes_queue.put( None )
+        worker = multiprocessing.Process( target=demultiplex_worker,
+                                          args=( tags, selector_options, tag_index, lanes_queue, results,
+                                                 interleaved, verbose, chunk_size, trash_prefix_length ) )
+        worker.daemon = True
+        worker.start()
+        workers.append( worker )
+
+    remaining = len( lanes )
+    while remaining :
+        try :
+            lane_number, chunk = results.get( timeout=1 )
+        except Empty :
+            # a killed process can't put its error in results.
+            exitcodes = [ worker.exitcode for worker in workers ]
+            if None not in exitcodes or any( exitcodes ) :
+                print("Error: a process stopped before the end of the lanes, exit codes %s" % exitcodes, file=sys.stderr)
+                for worker in workers :
+                    worker.terminate()
+                sys.exit( 1 )
+            continue
+
+        if chunk is None :
+            remaining -= 1
+
+        elif isinstance( chunk, str ) :
+            print("Error: can't demultiplex '%s': %s" % ( lanes[ lane_number ][0], chunk ), file=sys.stderr)
+            for worker in workers :
+                worker.terminate()
+            sys.exit( 1 )
+
+        else :
+            write( lane_number, *chunk )
+
+    for worker in workers :
+        worker.join()
+
+
 def parse_user_argument() :
     """
     Get user argument.
@@ -344,11 +1151,17 @@ def parse_user_argument() :
     parser = argparse.ArgumentParser( formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__ )
     parser.add_argument( 'file_adapt', metavar="FILE_TAG", nargs=1, type=argparse.FileType('r') )
 
-    parser.add_argument( '-f', '--fastq_1', dest="fastq_1", type=FastqFileType( "r" ), action='store',
-                            help="single-end file or paired-end file 1" )
+    parser.add_argument( '-f', '--fastq_1', dest="fastq_1", action='append', default=[],
+                            help="single-end file or paired-end file 1, repeat -f to demultiplex several lanes" )
 
-    parser.add_argument( '-F', '--fastq_2', dest="fastq_2", type=FastqFileType( "r" ), action='store', default=None,
-                            help="paired-end file 2" )
+    parser.add_argument( '-F', '--fastq_2', dest="fastq_2", action='append', default=[],
+                            help="paired-end file 2, one -F for each -f" )
+
+    parser.add_argument( '-j', '--jobs', dest="jobs", action='store', type=int, default=1,
+                            help="number of processes selecting reads, lanes are shared between processes" )
+
+    parser.add_argument( '-i', '--interleaved', dest="interleaved", action='store_true',
+                            help="paired-end reads are interleaved in the file given with -f, outputs are interleaved too" )
 
     parser.add_argument( '-p', '--output_prefix', dest="output_prefix", default="", action='store',
                             help="output file names are: PREFIX-NAME_IN_FILE_TAG.fastq"  )
@@ -359,114 +1172,188 @@ def parse_user_argument() :
     parser.add_argument( '-v', '--verbose', dest="verbose", action='store_true',
                             help="explain what is being done" )
 
+    parser.add_argument( '--profile', dest="profile", metavar="FOLDED_FILE", action='store', default=None,
+                            help="sample the stack while demultiplexing, write a flamegraph.pl compatible FOLDED_FILE and print a summary with selector events" )
+
     parser.add_argument( '-a', '--analogy', dest="analogy", action='store_true',
                             help="Compute the maximal Levenshtein ratio between adaptors" )
 
+    parser.add_argument( '--trash-report', dest="trash_report", metavar="K", action='store', type=int, default=None,
+                            help="count the starts of reads going to the * file and print the K most frequent with their nearest tag" )
+
+    parser.add_argument( '--max-memory', dest="max_memory", metavar="SIZE", action='store', type=parse_size, default=None,
+                            help="memory for output buffers and read chunks sent by processes, as 800M or 2G" )
+
+    parser.add_argument( '--index-cache', dest="index_cache", action='store_true',
+                            help="with -a, keep the ratios between tags in FILE_TAG.idx and reuse them while the tags are not modified" )
+
     parser.add_argument( '--all', dest="all", action='store_true',
                             help="if is enable, and levenshtein too with paired-end mode, All members of the paired-end must have rate greater than or equal to levenshtein rate and the same tag." )
 
     user_args = parser.parse_args()
+    if user_args.interleaved and user_args.fastq_2 :
+        parser.error( "argument -i/--interleaved: not allowed with argument -F/--fastq_2" )
+
+    if user_args.fastq_2 and len( user_args.fastq_2 ) != len( user_args.fastq_1 ) :
+        parser.error( "argument -F/--fastq_2: expected one -F for each -f" )
+
+    if not user_args.fastq_1 and not user_args.analogy :
+        parser.error( "argument -f/--fastq_1 is required" )
+
+    for fastq_name in user_args.fastq_1 + user_args.fastq_2 :
+        if not os.path.isfile( fastq_name ) :
+            parser.error( "can't open '%s'" % fastq_name )
+
+    if user_args.jobs < 1 :
+        parser.error( "argument -j/--jobs: must be at least 1" )
+
+    if user_args.profile and user_args.jobs > 1 :
+        parser.error( "argument --profile: not allowed with -j/--jobs greater than 1" )
+
     user_args.file_adapt = user_args.file_adapt[0]
-    user_args.single_end = user_args.fastq_2 is None
+    user_args.single_end = not user_args.fastq_2 and not user_args.interleaved
+    user_args.lanes = list( izip( user_args.fastq_1, user_args.fastq_2 or [ None ] * len( user_args.fastq_1 ) ) )
     return user_args
 
 def main() :
     user_args = parse_user_argument()
 
-    if not LEVENSHTEIN_IS_ENABLE and (user_args.levenshtein or user_args.analogy):
+    if user_args.levenshtein or user_args.analogy :
+        try :
+            import Levenshtein
+        except ImportError :
             print("ERROR: python-Levenshtein is not installed", file=sys.stderr)
             print("Please install python-Levenshtein to enable this feature", file=sys.stderr)
             print("See: https://pypi.org/project/python-Levenshtein/", file=sys.stderr)
             sys.exit(1)
 
+    tag_lines = read_tag_file( user_args.file_adapt, need_default=not user_args.analogy )
+    user_args.file_adapt.close()
+
     if user_args.analogy :
-        print("Maximal Levenshtein ratio between adaptors is %f" % get_maximal_annalogie( user_args.file_adapt ))
+        tag_index = TagIndex( sorted( adapt for adapt, name in tag_lines if adapt[0] != '*' ) )
+        if user_args.index_cache and not user_args.file_adapt.name.startswith( "<" ) :
+            load_neighbours( tag_index, user_args.file_adapt.name )
+        print("Maximal Levenshtein ratio between adaptors is %f" % get_maximal_annalogie( tag_index ))
         sys.exit(0)
 
-    output_files_by_adapt, defaults_files = make_tag_table( user_args.file_adapt,
+    output_files_by_adapt, defaults_files = make_tag_table( tag_lines,
                                                             user_args.output_prefix,
-                                                            not user_args.single_end )
-
-    nb_reads_writen = get_adapt_counter( user_args.file_adapt )
-
-    user_args.file_adapt.close()
-
-    if user_args.levenshtein :
-        if user_args.all :
-            select_output_file = LevenshteinAllSelector( output_files_by_adapt,
-                                                       user_args.single_end,
-                                                       user_args.levenshtein )
-
-        else :
-            select_output_file = Levenshtein_selector( output_files_by_adapt,
-                                                       user_args.single_end,
-                                                       user_args.levenshtein )
-    else :
-        select_output_file = Std_selector( output_files_by_adapt,
-                                           user_args.single_end )
-
-    # Single_end
-    if user_args.single_end :
-        default_file = defaults_files[0]
-        for str_read in user_args.fastq_1 :
-            read = Fastq_read( str_read )
-            adapt_and_line = select_output_file.select( read.seq )
-            if adapt_and_line is None :
-                if user_args.verbose :
-                    print("Read '%s' start with %s... and go to *" % (read.name, read.seq[ : 14 ]))
-                default_file.write( str( read ) )
-                nb_reads_writen[ '*' ][ 1 ] += 1
-
-            else :
-                (adapt, output_file) = adapt_and_line
-                if user_args.verbose :
-                    print("Read '%s' start with %s... and go to %s" % (read.name, read.seq[ : len( adapt ) ], adapt))
-
-                read.cut_start( len( adapt ) )
-                output_file.write( str( read ) )
-                nb_reads_writen[ adapt ][ 1 ] += 1
+                                                            not user_args.single_end,
+                                                            user_args.interleaved )
+
+    tags = [ line[ 0 ] for line in output_files_by_adapt ]
+    # Built once here and sent to processes, Std_selector does not use it.
+    tag_index = TagIndex( tags ) if user_args.levenshtein is not None else None
+    selector_options = ( user_args.single_end, user_args.levenshtein, user_args.all )
+
+    # output_files[ index ] are the files of tags[ index ], output_files[ -1 ] the files of *.
+    output_files = [ line[ 1 : ] for line in output_files_by_adapt ] + [ defaults_files ]
+    counts_by_lane = [ [ 0 ] * len( output_files ) for lane in user_args.lanes ]
+
+    budget = None
+    chunk_size = 10000
+    if user_args.max_memory :
+        import io
+        # each opened file has its own io buffer.
+        budget = MemoryBudget( user_args.max_memory,
+                               reserved=len( set( f for files in output_files for f in files ) ) * io.DEFAULT_BUFFER_SIZE )
+        if budget.reserved >= user_args.max_memory // 2 :
+            print("Error: --max-memory must be greater than %d bytes for %d output files" % ( 2 * budget.reserved, budget.reserved // io.DEFAULT_BUFFER_SIZE ),
+                  file=sys.stderr)
+            sys.exit( 1 )
+
+        if user_args.jobs > 1 :
+            # a quarter of the budget for chunks in the results queue ( 2 * jobs ) and in the workers ( jobs ).
+            chunks_bytes = ( user_args.max_memory - budget.reserved ) // 4
+            chunk_size = max( 1, chunks_bytes // ( 3 * user_args.jobs * estimate_read_size( user_args.lanes[0], user_args.interleaved ) ) )
+            budget.reserved += chunks_bytes
+        budget.max_bytes = user_args.max_memory - budget.reserved
+
+        buffered = {}
+        for files in output_files :
+            for output_file in files :
+                if output_file not in buffered :
+                    buffered[ output_file ] = BufferedFastqFile( output_file, budget )
+        output_files = [ tuple( buffered[ output_file ] for output_file in files ) for files in output_files ]
+
+    trash_prefixes = None
+    key_length = prefix_length = 0
+    if user_args.trash_report :
+        trash_prefixes = SpaceSaving( max( 10 * user_args.trash_report, 100 ) )
+        key_length, prefix_length = trash_prefix_lengths( tags )
+
+    if user_args.jobs > 1 :
+        def write( lane_number, groups, trashed ) :
+            write_groups( groups, output_files, counts_by_lane[ lane_number ] )
+            if trash_prefixes is not None :
+                for starts in trashed :
+                    add_trash_starts( trash_prefixes, starts, key_length )
+
+        demultiplex_parallel( user_args.lanes, user_args.jobs, tags, selector_options, tag_index, write,
+                              user_args.interleaved, user_args.verbose, chunk_size, prefix_length )
 
-        user_args.fastq_1.close()
-
-        for adapt, output_file in output_files_by_adapt :
-            output_file.close()
-
-    # Paired_end
     else :
-        (default_file_1, default_file_2) = defaults_files
-
-        for str_read_1, str_read_2 in izip( user_args.fastq_1, user_args.fastq_2 ) :
-            read_1 = Fastq_read( str_read_1 )
-            read_2 = Fastq_read( str_read_2 )
-
-            adapt_and_line = select_output_file.select( read_1.seq, read_2.seq )
-
-            if adapt_and_line is None :
-                default_file_1.write( str( read_1 ) )
-                default_file_2.write( str( read_2 ) )
-                nb_reads_writen[ '*' ][1] += 1
-
-            else :
-                (adapt, output_file_1, output_file_2 ) = adapt_and_line
+        select_output_file = make_selector( [ ( tag, index ) for index, tag in enumerate( tags ) ],
+                                            *selector_options, tag_index=tag_index )
 
-                read_1.cut_start( len( adapt ) )
-                read_2.cut_start( len( adapt ) )
-
-                output_file_1.write( str( read_1 ) )
-                output_file_2.write( str( read_2 ) )
-                nb_reads_writen[ adapt ][1] += 1
-
-        user_args.fastq_1.close()
-        user_args.fastq_2.close()
+        if user_args.profile :
+            select_output_file.count_events()
+            profiler = SamplingProfiler()
+            profiler.start()
 
-        for adapt, file_1, file_2 in output_files_by_adapt :
-            file_1.close()
-            file_2.close()
+        for lane_number, lane in enumerate( user_args.lanes ) :
+            try :
+                write_reads( select_reads( lane_reads( lane, user_args.interleaved ), select_output_file,
+                                           user_args.verbose, prefix_length ),
+                             output_files, counts_by_lane[ lane_number ], trash_prefixes, key_length )
+            except ValueError as error :
+                print("Error: %s" % error, file=sys.stderr)
+                sys.exit( 1 )
+
+        if user_args.profile :
+            profiler.stop()
+            profiler.write_folded( user_args.profile )
+            profiler.print_summary( select_output_file.events )
+
+    closed = set()
+    for files in output_files :
+        for output_file in files :
+            if output_file not in closed :
+                output_file.close()
+                closed.add( output_file )
 
     # show stat.
+    nb_reads_by_lane, nb_reads_writen = merge_lane_counts( tag_lines, tags, counts_by_lane )
+    if len( user_args.lanes ) > 1 :
+        for lane, nb_reads in zip( user_args.lanes, nb_reads_by_lane ) :
+            print( "%s:" % lane[0] )
+            for nb_reads_by_name in nb_reads.values() :
+                print( "    %s %d reads" % tuple( nb_reads_by_name ))
+
     for nb_reads_by_name in nb_reads_writen.values() :
         print( "%s %d reads" % tuple( nb_reads_by_name ))
 
+    if budget is not None :
+        print( "Peak buffered memory %.1f MB of %.1f MB" % ( budget.get_peak() / 1024.0 ** 2, user_args.max_memory / 1024.0 ** 2 ) )
+        try :
+            import resource
+        except ImportError :
+            pass
+        else :
+            # ru_maxrss is in kilobytes on Linux.
+            main_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+            print( "Peak resident memory %.1f MB for the main process" % main_rss )
+            if user_args.jobs > 1 :
+                # RUSAGE_CHILDREN gives the largest process which ended, not a sum.
+                worker_rss = resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss / 1024.0
+                nb_workers = min( user_args.jobs, len( user_args.lanes ) )
+                print( "Peak resident memory %.1f MB for the largest of %d processes, at most %.1f MB in all"
+                       % ( worker_rss, nb_workers, main_rss + nb_workers * worker_rss ) )
+
+    if trash_prefixes is not None :
+        print_trash_report( trash_prefixes, tags, user_args.trash_report )
+
 
 if __name__ == '__main__':
     main()
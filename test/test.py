@@ -33,6 +33,29 @@ def check_returned_paired_end_file() :
         os.remove( "./returned/" + file_name )
 
 
+def check_returned_interleaved_file( interleaved_file_name ) :
+    # the reads of each pair must follow each other as in the input file.
+    names = [ Fastq_read( read ).name for read in Fastq_file( interleaved_file_name, "r" ) ]
+    pairs = set( zip( names[ 0 : : 2 ], names[ 1 : : 2 ] ) )
+
+    for file_name in os.listdir("./returned") :
+        fq = Fastq_file( "./returned/" + file_name, "r" )
+        names = []
+        for read in fq :
+            if Fastq_read( read ).name[8:] != file_name[2:-6]:
+                print("Error, read %s is in file %s" % (Fastq_read( read ).name, file_name), file=sys.stderr)
+                sys.exit( 1 )
+            names.append( Fastq_read( read ).name )
+
+        for pair in zip( names[ 0 : : 2 ], names[ 1 : : 2 ] ) :
+            if pair not in pairs :
+                print("Error, reads %s and %s are not a pair in file %s" % (pair + (file_name,)), file=sys.stderr)
+                sys.exit( 1 )
+
+        print("Contain of file %-20s      [OK]" % file_name)
+        os.remove( "./returned/" + file_name )
+
+
 if not os.path.isdir('returned'):
     os.mkdir('returned')
 
@@ -50,9 +73,20 @@ print("Test single 100%")
 os.system( "python ../demultadapt.py  -f single-strcmp.fastq -p returned/r  adapt.txt" )
 check_returned_single_file()
 
+print("Test single multi-lane 100%")
+os.system( "python ../demultadapt.py  -f single-strcmp.fastq -f single-strcmp.fastq -j 2 -p returned/r  adapt.txt" )
+check_returned_single_file()
+
 print("Test paired levenshtein")
 os.system( "python ../demultadapt.py  -f paired-l1-1.fastq -F paired-l1-2.fastq -l 0.80 -p returned/r  adapt.txt" )
 check_returned_paired_end_file()
 
+print("Test interleaved levenshtein")
+os.system( "python ../demultadapt.py  -f paired-l1-interleaved.fastq -i -l 0.80 -p returned/r  adapt.txt" )
+check_returned_interleaved_file( "paired-l1-interleaved.fastq" )
+
+print("Test interleaved multi-lane levenshtein")
+os.system( "python ../demultadapt.py  -f paired-l1-interleaved.fastq -f paired-l1-interleaved.fastq -i -j 2 -l 0.80 -p returned/r  adapt.txt" )
+check_returned_interleaved_file( "paired-l1-interleaved.fastq" )
 
 print("All test pass")